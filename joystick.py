@@ -12,6 +12,7 @@ https://gist.github.com/rdb/8864666
 import os
 import struct
 import array
+import numpy as np
 from fcntl import ioctl
 from glob import glob
 from functools import wraps
@@ -26,11 +27,19 @@ def to_list(f):
 JoystickState = namedtuple('JoystickState', 'axis_map button_map axis_states button_states')
 Event = namedtuple('Event', 'time value type number')
 PollResult = namedtuple('PollResult', 'full_axis_states full_button_states event changed_axis changed_button')
+BatchPollResult = namedtuple('BatchPollResult', 'full_axis_states full_button_states num_events changed_axes changed_buttons')
 ButtonChange = namedtuple('ButtonChange', 'number button value')
 AxisChange = namedtuple('AxisChange', 'number axis ivalue fvalue')
 
 class Joystick(object):
     
+    # Maximum number of events coalesced by a single poll_all() call
+    BATCH_SIZE = 16
+    
+    # Layout of struct js_event from linux/joystick.h
+    _EVT = struct.Struct('IhBB')
+    _EVT_DTYPE = np.dtype([('time', '<u4'), ('value', '<i2'), ('type', 'u1'), ('number', 'u1')])
+    
     @classmethod
     def available_sticks(cls):
         return glob('/dev/input/js*')
@@ -38,27 +47,22 @@ class Joystick(object):
     def __init__(self, device_fn):
         self.dev_fn = device_fn
         self.dev = open(device_fn, 'rb')
+        self._evbuf = bytearray(self._EVT.size)
+        # Invariant for the lifetime of the device, so only ask once
+        self._num_axes = self.read_axis_count()
+        self._num_buttons = self.read_button_count()
         self.state = self.make_zero_state()
         
     def make_zero_state(self):
         
-        axis_map = []
-        axis_states = {}
-        button_map = []
-        button_states = {}
+        # Names are only kept for lookup; states are indexed by axis/button number
+        axis_map = self.read_axis_map()
+        button_map = self.read_button_map()
         
         state = JoystickState(axis_map=axis_map,
-                              axis_states=axis_states,
+                              axis_states=np.zeros(len(axis_map), dtype=np.float32),
                               button_map=button_map,
-                              button_states=button_states)
-        
-        for axis_name in self.read_axis_map():
-            axis_map.append(axis_name)
-            axis_states[axis_name] = 0.0
-        
-        for button_name in self.read_button_map():
-            button_map.append(button_name)
-            button_states[button_name] = 0
+                              button_states=np.zeros(len(button_map), dtype=np.uint8))
         
         return state
         
@@ -93,8 +97,7 @@ class Joystick(object):
         buf = array.array('B', [0] * 0x40)
         ioctl(self.dev, 0x80406a32, buf) # JSIOCGAXMAP
 
-        num_axes = self.read_axis_count()
-        for axis in buf[:num_axes]:
+        for axis in buf[:self._num_axes]:
             axis_name = self.AXIS_NAMES.get(axis, 'unknown(0x%02x)' % axis)
             yield axis_name            
         
@@ -103,15 +106,18 @@ class Joystick(object):
         buf = array.array('H', [0] * 200)
         ioctl(self.dev, 0x80406a34, buf) # JSIOCGBTNMAP
 
-        num_buttons = self.read_button_count()
-        for btn in buf[:num_buttons]:
+        for btn in buf[:self._num_buttons]:
             btn_name = self.BUTTON_NAMES.get(btn, 'unknown(0x%03x)' % btn)
             yield btn_name
             
-    def poll(self):
-        evbuf = self.dev.read(8)
-        if evbuf:
-            time, value, type, number = struct.unpack('IhBB', evbuf)
+    def poll(self, snapshot=False):
+        """Reads a single event and returns a PollResult, or None on EOF.
+        
+        Unless snapshot is set, full_axis_states and full_button_states are the
+        live state arrays, which the next poll overwrites in place.
+        """
+        if self.dev.readinto(self._evbuf) == self._EVT.size:
+            time, value, type, number = self._EVT.unpack_from(self._evbuf)
             event = Event(time=time, value=value, type=type, number=number)
             
             changed_axis = None
@@ -120,32 +126,66 @@ class Joystick(object):
             #if type & 0x80:
             #    print("(initial)")
 
+            # Every number has a (possibly 'unknown(..)') name, so no lookup
+            # is needed to decide whether to update the state
             if type & 0x01:
-                button = self.state.button_map[number]
-                if button:
-                    self.state.button_states[button] = value
-                    changed_button = ButtonChange(number, button, value)
-                    #if value:
-                    #    print("%s pressed" % (button))
-                    #else:
-                    #    print("%s released" % (button))
+                self.state.button_states[number] = value
+                changed_button = ButtonChange(number, self.state.button_map[number], value)
+                #if value:
+                #    print("%s pressed" % (changed_button.button))
+                #else:
+                #    print("%s released" % (changed_button.button))
 
             if type & 0x02:
-                axis = self.state.axis_map[number]
-                if axis:
-                    fvalue = value / 32767.0
-                    self.state.axis_states[axis] = fvalue
-                    changed_axis = AxisChange(number, axis, value, fvalue)
-                    #print("%s: %.3f" % (axis, fvalue))
+                fvalue = value / 32767.0
+                self.state.axis_states[number] = fvalue
+                changed_axis = AxisChange(number, self.state.axis_map[number], value, fvalue)
+                #print("%s: %.3f" % (changed_axis.axis, fvalue))
             
+            axis_states, button_states = self._state_arrays(snapshot)
             result = PollResult(event=event,
-                                full_axis_states=self.state.axis_states.copy(),
-                                full_button_states = self.state.button_states.copy(),
+                                full_axis_states=axis_states,
+                                full_button_states=button_states,
                                 changed_axis=changed_axis,
                                 changed_button=changed_button)
             return result
         else:
             return None
+    
+    def poll_all(self, snapshot=False):
+        """Reads all pending events at once and returns them coalesced into one BatchPollResult
+        """
+        evbuf = os.read(self.dev.fileno(), self._EVT.size * self.BATCH_SIZE)
+        if not evbuf:
+            return None
+        
+        events = np.frombuffer(evbuf, dtype=self._EVT_DTYPE)
+        
+        buttons = self._latest_per_number(events[(events['type'] & 0x01) != 0])
+        self.state.button_states[buttons['number']] = buttons['value']
+        
+        axes = self._latest_per_number(events[(events['type'] & 0x02) != 0])
+        self.state.axis_states[axes['number']] = axes['value'] / 32767.0
+        
+        axis_states, button_states = self._state_arrays(snapshot)
+        result = BatchPollResult(full_axis_states=axis_states,
+                                 full_button_states=button_states,
+                                 num_events=len(events),
+                                 changed_axes=axes['number'],
+                                 changed_buttons=buttons['number'])
+        return result
+    
+    @staticmethod
+    def _latest_per_number(events):
+        # Fancy assignment does not define which of several values for the same
+        # index is stored, so only the last event per number is kept
+        _, idx = np.unique(events['number'][::-1], return_index=True)
+        return events[::-1][idx]
+    
+    def _state_arrays(self, snapshot):
+        if snapshot:
+            return self.state.axis_states.copy(), self.state.button_states.copy()
+        return self.state.axis_states, self.state.button_states
             
         # These constants were borrowed from linux/input.h
     AXIS_NAMES = {
@@ -1,17 +1,25 @@
 # -*- coding:utf-8 -*-
 
+import os
 import sys
+import time
 import joystick
 import serial
 import threading
-import numpy as np
-from rx import Observable
+import collections
+import select
 from rx.subjects import Subject
-from rx.concurrency import NewThreadScheduler
 
 FEEDRATE = 400 # mm / minute
 MAX_REACH = 0.2 # mm / feedrate
 MIN_NORM = 0.2
+POLL_TIMEOUT = 50 # ms
+BOOT_TIMEOUT = 5 # s
+BANNER_TIMEOUT = 0.5 # s
+MOVE_GCODE = b'G1 X%.3f Y%.3f F%d'
+QUICKSTOP_GCODE = b'M410'
+RT_CPU = None # CPU for the joystick thread, None for the last one available
+RT_PRIORITY = 50
 
 device_fn = sys.argv[1] if len(sys.argv)>1 else joystick.Joystick.available_sticks()[0]
 print("Using input device: {0}".format(device_fn))
@@ -19,46 +27,131 @@ print("Using input device: {0}".format(device_fn))
 in_stick = joystick.Joystick(device_fn)
 tty = serial.Serial('/dev/ttyUSB0',250000)
 
+def wait_for_printer():
+  """Waits for the printer to finish booting and discards its startup banner
+  """
+  # A board that keeps talking (e.g. temperature auto-reports) may never print
+  # 'start' nor go quiet, so both phases also have an overall deadline
+  deadline = time.monotonic() + BOOT_TIMEOUT
+  while time.monotonic() < deadline:
+    tty.timeout = max(deadline - time.monotonic(), 0)
+    line = tty.readline()
+    if not line or line.startswith(b'start'):
+      break
+  # The banner (echo: lines) follows 'start'; read until the printer goes quiet
+  tty.timeout = BANNER_TIMEOUT
+  deadline = time.monotonic() + BOOT_TIMEOUT
+  while time.monotonic() < deadline and tty.readline():
+    pass
+  tty.timeout = None
+
 def send_gcode(s):
-  tty.flushInput()
+  """Sends a command and returns the printer's 'ok' reply, or None on timeout
+  """
   tty.write(s + b'\n')
-  return tty.readline().strip()
-
-def poll_joystick(_):
-  poll_result = in_stick.poll()
+  for line in iter(tty.readline, b''):
+    if line.startswith(b'ok'):
+      return line.strip()
+  return None
+
+print("Waiting for printer")
+wait_for_printer()
+
+# Relative positioning, stays in effect for all following moves. Jogging only
+# starts once the printer has acknowledged it, otherwise moves would be absolute.
+tty.timeout = BOOT_TIMEOUT
+if send_gcode(b'G91') is None:
+  sys.exit("Printer did not acknowledge G91")
+tty.timeout = None
+
+def make_realtime(priority, cpu=None):
+  """Gives the calling thread SCHED_FIFO priority and optionally pins it to cpu
+  """
+  if cpu is not None:
+    try:
+      os.sched_setaffinity(0, {cpu})
+    except OSError as e:
+      print("Could not pin thread to CPU {0}: {1}".format(cpu, e))
+  try:
+    os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+  except PermissionError:
+    try:
+      os.nice(-10)
+    except PermissionError:
+      pass
+
+def poll_joystick(poll_result):
   x, y = None, None
-  if poll_result.changed_axis is not None:
-    axis = poll_result.changed_axis
-    if axis.number == 0:
-        x = axis.fvalue
-    elif axis.number == 1:
-        y = axis.fvalue
+  if 0 in poll_result.changed_axes:
+    x = poll_result.full_axis_states[0]
+  if 1 in poll_result.changed_axes:
+    y = poll_result.full_axis_states[1]
   return x, y
 
 def update_position(accu, update):
   return tuple( (current if current is not None else previous) for current, previous in zip(update, accu) )
 
-joystick_positions = Observable.interval(1).map(poll_joystick).scan(update_position, (0,0))
-
-cv = threading.Condition()
-new_position = None
-
-def new_position_available():
-  global new_position
-  return new_position is not None
+joystick_events = Subject()
+shutdown = threading.Event()
+
+def read_joystick():
+  # Only the producer is pinned, so it never queues behind the serial thread
+  make_realtime(RT_PRIORITY, RT_CPU if RT_CPU is not None else max(os.sched_getaffinity(0)))
+  poller = select.poll()
+  poller.register(in_stick.dev.fileno(), select.POLLIN)
+  try:
+    while not shutdown.is_set():
+      # Sleep until the kernel has an event, waking up now and then to check for shutdown
+      ready = poller.poll(POLL_TIMEOUT)
+      if not ready:
+        continue
+      # Joystick unplugged
+      if ready[0][1] & (select.POLLHUP | select.POLLERR):
+        break
+      poll_result = in_stick.poll_all(snapshot=False)
+      if poll_result is None:
+        break
+      joystick_events.on_next(poll_result)
+  finally:
+    # Without input the current move must not be repeated any longer. Always
+    # queue the quickstop so the consumer also wakes up to see a shutdown.
+    pending_move.append(QUICKSTOP_GCODE)
+    move_available.set()
+
+joystick_positions = joystick_events.map(poll_joystick).scan(update_position, (0,0))
+
+# Single slot holding the command for the current stick position. A G1 is repeated
+# for as long as the stick stays deflected, paced by the printer's replies. Marlin
+# replies as soon as a move enters its planner, so this keeps the planner buffer
+# full; releasing the stick replaces the G1 with a quickstop that discards it.
+pending_move = collections.deque(maxlen=1)
+move_available = threading.Event()
+
+def stop_jog():
+  if pending_move and pending_move[-1] != QUICKSTOP_GCODE:
+    pending_move.append(QUICKSTOP_GCODE)
+    move_available.set()
 
 def execute_move():
-  global cv, new_position
+  make_realtime(RT_PRIORITY - 1)
+  last_gcode = None
   while True:
-    with cv:
-      cv.wait_for(new_position_available)
-      dx, dy = new_position
-      new_position = None
-      
-    # Relative positioning
-    send_gcode(b'G91')
-    # Rapid move
-    send_gcode('G1 X{:.3f} Y{:.3f} F{}'.format(dx, -dy, FEEDRATE).encode('ascii'))
+    move_available.wait()
+    gcode = pending_move[-1]
+    # Console output stays off the joystick thread
+    if gcode != last_gcode:
+      print(gcode.decode('ascii'))
+      last_gcode = gcode
+    # Rapid move or quickstop
+    send_gcode(gcode)
+    if gcode == QUICKSTOP_GCODE:
+      if shutdown.is_set():
+        break
+      # Sleep until the next move; check again after clearing so a move queued
+      # in between is not missed
+      move_available.clear()
+      if pending_move[-1] != QUICKSTOP_GCODE:
+        move_available.set()
 
 consumer_thread = threading.Thread(target=execute_move)
 consumer_thread.daemon = True
@@ -66,20 +159,31 @@ consumer_thread.start()
 
 
 def move_printer(delta):
-  global cv, new_position
-  if np.linalg.norm(delta) > MIN_NORM:
-    dx, dy = np.array(delta) * MAX_REACH
-    print(dx, dy)
-    with cv:
-      new_position = dx, dy
-      cv.notify()
+  dx, dy = delta
+  # Compare squared lengths to skip the sqrt
+  if dx*dx + dy*dy > MIN_NORM*MIN_NORM:
+    dx, dy = dx * MAX_REACH, dy * MAX_REACH
+    gcode = MOVE_GCODE % (dx, -dy, FEEDRATE)
+    # Stick noise below the output resolution does not change the move being repeated
+    if pending_move and pending_move[-1] == gcode:
+      return
+    pending_move.append(gcode)
+    move_available.set()
+  else:
+    stop_jog()
 
 joystick_positions \
   .filter(lambda pos: all(val is not None for val in pos)) \
-  .combine_latest(Observable.interval(20), lambda a,b: a) \
-  .observe_on(NewThreadScheduler()) \
   .subscribe(on_next=move_printer)
 
+producer_thread = threading.Thread(target=read_joystick)
+producer_thread.daemon = True
+producer_thread.start()
+
 
 input("Press any key to exit\n")
+shutdown.set()
+producer_thread.join()
+# Give the consumer the chance to send the final quickstop
+consumer_thread.join(BOOT_TIMEOUT)
 